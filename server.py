@@ -6,205 +6,387 @@
 
 # Import libraries
 import asyncio
+import hmac
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Depends, Security
-from fastapi.security.api_key import APIKeyHeader
+from fastapi import FastAPI, HTTPException, Depends, Body
+from starlette.middleware.gzip import GZipMiddleware
+import httpx
 import spotipy
-from spotipy import Spotify
 from spotipy.oauth2 import SpotifyOAuth
 from pydantic import BaseModel
+from typing import Optional, Union
 import os
 import logging
 
-from fastapi import FastAPI
-from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI()
+# Pure ASGI CORS middleware (avoids the per-request overhead of wrapped middleware)
+class PureCORS:
+    def __init__(self, app, origins, methods=("GET", "POST", "OPTIONS")):
+        self.app = app
+        # Response headers are built once per allowed origin, keyed by the raw Origin header
+        self._cors_headers = {}
+        self._preflight_headers = {}
+        for origin in origins:
+            cors_headers = (
+                (b"access-control-allow-origin", origin.encode()),
+                (b"access-control-allow-credentials", b"true"),
+                (b"vary", b"Origin"),
+            )
+            self._cors_headers[origin.encode()] = cors_headers
+            self._preflight_headers[origin.encode()] = cors_headers + (
+                (b"access-control-allow-methods", ",".join(methods).encode()),
+                (b"access-control-max-age", b"600"),
+            )
 
-# Enable CORS for your frontend
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:3000"],  # Allow requests from your frontend domain
-    allow_credentials=True,
-    allow_methods=["GET", "POST", "OPTIONS"],  # Allow methods
-    allow_headers=["*"],  # Allow headers
-)
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
 
-@app.get("/current-song")
-async def get_current_song():
-    # Your logic to return song data
-    return {"song_name": "Song Title", "artist": "Artist", "image_url": "image_url", "progress_ms": 12000, "duration_ms": 240000}
+        headers = dict(scope["headers"])
+        origin = headers.get(b"origin")
+        cors_headers = self._cors_headers.get(origin)
+        if cors_headers is None:
+            return await self.app(scope, receive, send)
 
-@app.post("/seek")
-async def update_song_progress(progress_ms: int):
-    # Your logic to update the song progress
-    return {"message": "Progress updated"}
+        # Answer preflight requests directly
+        if scope["method"] == "OPTIONS" and b"access-control-request-method" in headers:
+            allow_headers = headers.get(b"access-control-request-headers", b"*")
+            preflight_headers = self._preflight_headers[origin] + ((b"access-control-allow-headers", allow_headers),)
+            await send({"type": "http.response.start", "status": 204, "headers": preflight_headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", ()), *cors_headers]
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+# Pure ASGI API key check, reads the header straight from the scope
+class APIKeyASGI:
+    def __init__(self, app, key, protected_paths):
+        self.app = app
+        self.key = key
+        self.protected_paths = frozenset(protected_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.protected_paths:
+            for name, value in scope["headers"]:
+                if name == b"x-api-key" and hmac.compare_digest(value, self.key):
+                    break
+            else:
+                await send({"type": "http.response.start", "status": 401,
+                            "headers": [(b"content-type", b"application/json")]})
+                await send({"type": "http.response.body",
+                            "body": b'{"detail":"Unauthorized. Invalid or missing API key."}'})
+                return
+        await self.app(scope, receive, send)
 
+# Pure ASGI per-IP token bucket rate limiter, bounded with LRU eviction.
+# Buckets live in process memory, so the limit applies per worker process.
+class TokenBucketASGI:
+    def __init__(self, app, rate, capacity, limited_paths, max_clients=10000, trusted_proxies=()):
+        self.app = app
+        self.rate = rate
+        self.capacity = capacity
+        self.limited_paths = frozenset(limited_paths)
+        self.max_clients = max_clients
+        self.trusted_proxies = frozenset(trusted_proxies)
+        self.buckets = OrderedDict()
 
-# Load environment variables
-load_dotenv()
+    def _client_ip(self, scope):
+        client = scope.get("client")
+        ip = client[0] if client else None
+        # Behind a trusted reverse proxy, use the address the proxy appended to X-Forwarded-For.
+        # Walk the headers in reverse: some proxies add their own header line instead of
+        # merging into the one the client sent, so only the last one can be trusted.
+        if ip in self.trusted_proxies:
+            for name, value in reversed(scope["headers"]):
+                if name == b"x-forwarded-for":
+                    ip = value.decode("latin-1").rsplit(",", 1)[-1].strip() or ip
+                    break
+        return ip
 
-# Spotify API credentials
-CLIENT_ID = os.getenv('CLIENT_ID')
-CLIENT_SECRET = os.getenv('CLIENT_SECRET')
-REDIRECT_URI = os.getenv('REDIRECT_URI')
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["path"] in self.limited_paths:
+            ip = self._client_ip(scope)
+            now = time.monotonic()
+            tokens, last = self.buckets.pop(ip, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[ip] = (tokens, now)
+                retry_after = str(int((1 - tokens) / self.rate) + 1).encode()
+                await send({"type": "http.response.start", "status": 429,
+                            "headers": [(b"content-type", b"application/json"), (b"retry-after", retry_after)]})
+                await send({"type": "http.response.body", "body": b'{"detail":"Too many requests."}'})
+                return
+            self.buckets[ip] = (tokens - 1, now)
+            if len(self.buckets) > self.max_clients:
+                self.buckets.popitem(last=False)
+        await self.app(scope, receive, send)
+
+
+# Settings loaded from the environment (and .env) once per process
+@dataclass(frozen=True)
+class Settings:
+    client_id: Optional[str]
+    client_secret: Optional[str]
+    redirect_uri: Optional[str]
+    api_key_bytes: bytes  # Pre-encoded for the API key middleware
+    trusted_proxies: tuple[str, ...]
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    load_dotenv()
+    return Settings(
+        client_id=os.getenv('CLIENT_ID'),
+        client_secret=os.getenv('CLIENT_SECRET'),
+        redirect_uri=os.getenv('REDIRECT_URI'),
+        api_key_bytes=os.getenv('API_KEY', 'default-api-key').encode(),  # Use a secure value for production
+        trusted_proxies=tuple(ip.strip() for ip in os.getenv('TRUSTED_PROXIES', '').split(',') if ip.strip()),
+    )
+
+SETTINGS = get_settings()
 
 # API Key setup
-API_KEY = os.getenv('API_KEY', 'default-api-key')  # Use a secure value for production
-API_KEY_HEADER = APIKeyHeader(name="X-API-Key", auto_error=False)
+PROTECTED_PATHS = ["/", "/play", "/pause", "/next", "/previous", "/device"]
+
+# Rate limiting (per client IP, per worker process; the server runs a single worker)
+# Set the TRUSTED_PROXIES env var to the reverse proxy addresses so X-Forwarded-For is honored,
+# otherwise every user behind the proxy shares one bucket.
+RATE_LIMITED_PATHS = ["/play", "/pause", "/next", "/previous", "/callback"]
+RATE_LIMIT_PER_SECOND = 2.0
+RATE_LIMIT_BURST = 10
 
 # Configure Spotify authentication
 scope = "user-modify-playback-state user-read-playback-state"
-sp_oauth = SpotifyOAuth(client_id=CLIENT_ID,
-                        client_secret=CLIENT_SECRET,
-                        redirect_uri=REDIRECT_URI,
+sp_oauth = SpotifyOAuth(client_id=SETTINGS.client_id,
+                        client_secret=SETTINGS.client_secret,
+                        redirect_uri=SETTINGS.redirect_uri,
                         scope=scope)
-
-# Initialize FastAPI app
-app = FastAPI()
+# No state is configured, so the authorization URL never changes
+AUTH_URL = sp_oauth.get_authorize_url()
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Dependency for API key validation
-def get_api_key(api_key: str = Depends(API_KEY_HEADER)):
-    if api_key != API_KEY:
-        raise HTTPException(status_code=401, detail="Unauthorized. Invalid or missing API key.")
-    return api_key
+# Shared async client for the Spotify Web API (keep-alive connections, HTTP/2),
+# opened and closed with the app so each startup gets a fresh client
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.spotify_http = httpx.AsyncClient(http2=True, base_url="https://api.spotify.com", timeout=5.0,
+                                               limits=httpx.Limits(max_keepalive_connections=20))
+    try:
+        yield
+    finally:
+        await app.state.spotify_http.aclose()
+
+# Initialize FastAPI app
+app = FastAPI(lifespan=lifespan)
+
+# Middleware (the last one added runs first: CORS, rate limiting, API key check, then gzip)
+app.add_middleware(GZipMiddleware, minimum_size=500, compresslevel=6)
+app.add_middleware(APIKeyASGI, key=SETTINGS.api_key_bytes, protected_paths=PROTECTED_PATHS)
+app.add_middleware(TokenBucketASGI, rate=RATE_LIMIT_PER_SECOND, capacity=RATE_LIMIT_BURST,
+                   limited_paths=RATE_LIMITED_PATHS, trusted_proxies=SETTINGS.trusted_proxies)
+app.add_middleware(PureCORS, origins=["http://localhost:3000"])  # Allow requests from your frontend domain
 
-# Dependency to get authenticated Spotify client
-def get_spotify_client():
+# Dependency to get the current Spotify access token
+# (plain def, so FastAPI runs the token lookup in its threadpool)
+def get_access_token():
     token_info = sp_oauth.get_cached_token()
     if not token_info or sp_oauth.is_token_expired(token_info):
         raise HTTPException(status_code=401, detail="Unauthorized. Please authenticate.")
-    return Spotify(auth=token_info['access_token'])
+    return token_info['access_token']
+
+# Retry rate-limited and server-error responses like spotipy does
+SPOTIFY_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+SPOTIFY_MAX_RETRIES = 3
+SPOTIFY_BACKOFF_FACTOR = 0.3
+SPOTIFY_MAX_RETRY_DELAY = 5.0  # Longer Retry-After waits are reported instead of held open
+
+async def spotify_request(method: str, path: str, token: str, params: Optional[dict] = None):
+    """Call the Spotify Web API, raising SpotifyException on error responses."""
+    if params:
+        params = {key: value for key, value in params.items() if value is not None}
+    for attempt in range(SPOTIFY_MAX_RETRIES + 1):
+        response = await app.state.spotify_http.request(method, path, params=params,
+                                                        headers={"Authorization": f"Bearer {token}"})
+        if response.status_code not in SPOTIFY_RETRY_STATUSES or attempt == SPOTIFY_MAX_RETRIES:
+            break
+        try:
+            delay = float(response.headers["retry-after"])
+        except (KeyError, ValueError):
+            delay = SPOTIFY_BACKOFF_FACTOR * 2 ** attempt
+        if delay > SPOTIFY_MAX_RETRY_DELAY:
+            break
+        await asyncio.sleep(delay)
+    if response.is_error:
+        try:
+            msg = response.json()["error"]["message"]
+        except (ValueError, KeyError, TypeError):
+            msg = response.text
+        raise spotipy.exceptions.SpotifyException(response.status_code, -1, f"{response.request.url}:\n {msg}",
+                                                  headers=response.headers)
+    try:
+        return response.json()
+    except ValueError:
+        # Like spotipy, treat an empty or non-JSON success body as no result
+        return None
+
+# Short-lived cache of available devices, keyed by access token
+DEVICE_CACHE_TTL = 5.0
+_DEVICE_CACHE: dict[str, tuple[float, list]] = {}
+
+async def get_devices_cached(token: str, ttl: float = DEVICE_CACHE_TTL):
+    now = time.monotonic()
+    hit = _DEVICE_CACHE.get(token)
+    if hit and now - hit[0] < ttl:
+        return hit[1]
+    response = await spotify_request("GET", "/v1/me/player/devices", token)
+    devices = response['devices']
+    # Drop expired entries so rotated tokens don't pile up
+    for stale in [key for key, (fetched, _) in _DEVICE_CACHE.items() if now - fetched >= ttl]:
+        del _DEVICE_CACHE[stale]
+    _DEVICE_CACHE[token] = (now, devices)
+    return devices
+
+def invalidate_devices(token: str):
+    _DEVICE_CACHE.pop(token, None)
+
+async def player_command(method: str, path: str, token: str, device_id: Optional[str], action: str):
+    """Send a playback command to a device, translating Spotify errors into HTTP errors."""
+    try:
+        await spotify_request(method, path, token, params={"device_id": device_id})
+    except spotipy.exceptions.SpotifyException as e:
+        if e.http_status == 404:
+            invalidate_devices(token)
+            raise HTTPException(status_code=404, detail="Device not found.")
+        logger.error("Spotify error: %s", e)
+        raise HTTPException(status_code=400, detail=f"Spotify error: {e}")
+    except Exception as e:
+        logger.error("Error during %s: %s", action, e)
+        raise HTTPException(status_code=500, detail=f"Server error: {e}")
+
+# Response models (let FastAPI serialize responses straight through pydantic-core)
+class MessageResponse(BaseModel):
+    message: str
+
+class AuthURLResponse(BaseModel):
+    auth_url: str
+
+class SongResponse(BaseModel):
+    song_name: str
+    artist: str
+    image_url: str
+    progress_ms: int
+    duration_ms: int
+
+class DeviceInfo(BaseModel):
+    id: Optional[str]
+    name: str
+    type: str
 
-# API models
-class PlaybackRequest(BaseModel):
-    device_id: str = None  # Optional: Specify a device ID
+class DevicesResponse(BaseModel):
+    devices: list[DeviceInfo]
 
 # Routes
-@app.get("/", dependencies=[Depends(get_api_key)])
+@app.get("/", response_model=MessageResponse)
 async def root():
     return {"message": "Welcome to the Meowseek Widget API"}
 
-@app.get("/auth")
+@app.get("/current-song", response_model=SongResponse)
+async def get_current_song():
+    # Your logic to return song data
+    return {"song_name": "Song Title", "artist": "Artist", "image_url": "image_url", "progress_ms": 12000, "duration_ms": 240000}
+
+@app.post("/seek", response_model=MessageResponse)
+async def update_song_progress(progress_ms: int):
+    # Your logic to update the song progress
+    return {"message": "Progress updated"}
+
+@app.get("/auth", response_model=AuthURLResponse)
 async def auth():
     """Get the Spotify authorization URL."""
-    auth_url = sp_oauth.get_authorize_url()
-    return {"auth_url": auth_url}
+    return {"auth_url": AUTH_URL}
 
-@app.get("/callback")
+@app.get("/callback", response_model=MessageResponse)
 async def callback(code: str):
     """Spotify callback route to handle token exchange."""
     try:
-        token_info = sp_oauth.get_access_token(code)
+        token_info = await asyncio.to_thread(sp_oauth.get_access_token, code)
         if not token_info:
             raise HTTPException(status_code=400, detail="Failed to get access token.")
     except Exception as e:
-        logger.error(f"Error during token exchange: {e}")
+        logger.error("Error during token exchange: %s", e)
         raise HTTPException(status_code=400, detail=f"Error during token exchange: {e}")
     return {"message": "Authentication successful. You can now use the API."}
 
-@app.post("/play", dependencies=[Depends(get_api_key)])
-async def play_song(request: PlaybackRequest, sp: Spotify = Depends(get_spotify_client)):
+@app.post("/play", response_model=MessageResponse)
+async def play_song(device_id: Optional[str] = Body(None, embed=True),
+                    token: str = Depends(get_access_token)):
     """Play the current song."""
-    try:
-        # Get available devices
-        devices = sp.devices()['devices']
-        logger.info(f"Available devices: {devices}")
+    logger.info("Starting playback on device %s", device_id)
+    # Start playback (Spotify answers 404 itself if the device does not exist)
+    await player_command("PUT", "/v1/me/player/play", token, device_id, "playback")
+    return {"message": "Playback started."}
 
-        if not any(device["id"] == request.device_id for device in devices):
-            raise HTTPException(status_code=404, detail="Device not found.")
-
-        # Check if the device is active
-        active_device = next((device for device in devices if device["id"] == request.device_id), None)
-        if not active_device or not active_device.get('is_active', False):
-            raise HTTPException(status_code=400, detail="Device is not active.")
-        
-        logger.info(f"Starting playback on device {request.device_id}")
-        # Start playback
-        sp.start_playback(device_id=request.device_id)
-        return {"message": "Playback started."}
-
-    except spotipy.exceptions.SpotifyException as e:
-        logger.error(f"Spotify error: {e}")
-        raise HTTPException(status_code=400, detail=f"Spotify error: {e}")
-    except Exception as e:
-        logger.error(f"Error during playback: {e}")
-        raise HTTPException(status_code=500, detail=f"Server error: {e}")
-
-@app.post("/pause", dependencies=[Depends(get_api_key)])
-async def pause_song(request: PlaybackRequest, sp: Spotify = Depends(get_spotify_client)):
+@app.post("/pause", response_model=MessageResponse)
+async def pause_song(device_id: Optional[str] = Body(None, embed=True),
+                     token: str = Depends(get_access_token)):
     """Pause the current song."""
-    try:
-        # Validate device ID
-        devices = sp.devices()['devices']
-        if not any(device["id"] == request.device_id for device in devices):
-            raise HTTPException(status_code=404, detail="Device not found.")
-        
-        sp.pause_playback(device_id=request.device_id)
-        return {"message": "Playback paused."}
-    except spotipy.exceptions.SpotifyException as e:
-        logger.error(f"Spotify error: {e}")
-        raise HTTPException(status_code=400, detail=f"Spotify error: {e}")
-    except Exception as e:
-        logger.error(f"Error during pause: {e}")
-        raise HTTPException(status_code=500, detail=f"Server error: {e}")
+    await player_command("PUT", "/v1/me/player/pause", token, device_id, "pause")
+    return {"message": "Playback paused."}
 
-@app.post("/next", dependencies=[Depends(get_api_key)])
-async def next_song(request: PlaybackRequest, sp: Spotify = Depends(get_spotify_client)):
+@app.post("/next", response_model=MessageResponse)
+async def next_song(device_id: Optional[str] = Body(None, embed=True),
+                    token: str = Depends(get_access_token)):
     """Skip to the next song."""
-    try:
-        # Validate device ID
-        devices = sp.devices()['devices']
-        if not any(device["id"] == request.device_id for device in devices):
-            raise HTTPException(status_code=404, detail="Device not found.")
-        
-        sp.next_track(device_id=request.device_id)
-        return {"message": "Skipped to the next song."}
-    except spotipy.exceptions.SpotifyException as e:
-        logger.error(f"Spotify error: {e}")
-        raise HTTPException(status_code=400, detail=f"Spotify error: {e}")
-    except Exception as e:
-        logger.error(f"Error during next song: {e}")
-        raise HTTPException(status_code=500, detail=f"Server error: {e}")
+    await player_command("POST", "/v1/me/player/next", token, device_id, "next song")
+    return {"message": "Skipped to the next song."}
 
-@app.post("/previous", dependencies=[Depends(get_api_key)])
-async def previous_song(request: PlaybackRequest, sp: Spotify = Depends(get_spotify_client)):
+@app.post("/previous", response_model=MessageResponse)
+async def previous_song(device_id: Optional[str] = Body(None, embed=True),
+                        token: str = Depends(get_access_token)):
     """Go back to the previous song."""
-    try:
-        # Validate device ID
-        devices = sp.devices()['devices']
-        if not any(device["id"] == request.device_id for device in devices):
-            raise HTTPException(status_code=404, detail="Device not found.")
-        
-        sp.previous_track(device_id=request.device_id)
-        return {"message": "Went back to the previous song."}
-    except spotipy.exceptions.SpotifyException as e:
-        logger.error(f"Spotify error: {e}")
-        raise HTTPException(status_code=400, detail=f"Spotify error: {e}")
-    except Exception as e:
-        logger.error(f"Error during previous song: {e}")
-        raise HTTPException(status_code=500, detail=f"Server error: {e}")
+    await player_command("POST", "/v1/me/player/previous", token, device_id, "previous song")
+    return {"message": "Went back to the previous song."}
 
-@app.get("/device", dependencies=[Depends(get_api_key)])
-async def get_devices(sp: Spotify = Depends(get_spotify_client)):
+@app.get("/device", response_model=Union[DevicesResponse, MessageResponse])
+async def get_devices(token: str = Depends(get_access_token)):
     """Get a list of available devices."""
     try:
-        devices = sp.devices()
-        logger.info(f"Available devices: {devices}")
+        devices = await get_devices_cached(token)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("Available devices: %s", devices)
 
-        if not devices['devices']:
+        if not devices:
             return {"message": "No devices found."}
 
-        device_list = [{"id": device["id"], "name": device["name"], "type": device["type"]} for device in devices['devices']]
+        device_list = [{"id": device["id"], "name": device["name"], "type": device["type"]} for device in devices]
         return {"devices": device_list}
     except spotipy.exceptions.SpotifyException as e:
-        logger.error(f"Spotify error: {e}")
+        logger.error("Spotify error: %s", e)
         raise HTTPException(status_code=400, detail=f"Spotify error: {e}")
     except Exception as e:
-        logger.error(f"Error fetching devices: {e}")
+        logger.error("Error fetching devices: %s", e)
         raise HTTPException(status_code=500, detail=f"Server error: {e}")
 
+
+if __name__ == "__main__":
+    import importlib.util
+    import uvicorn
+
+    # Pin uvloop and httptools so uvicorn never silently falls back to asyncio + h11
+    # (uvloop is not available on Windows, so let uvicorn pick the loop there)
+    loop = "uvloop" if importlib.util.find_spec("uvloop") else "auto"
+    # A single worker: handlers are async and I/O-bound, and the rate limiter and
+    # device cache are per process, so extra workers would multiply the limits
+    uvicorn.run("server:app", host="0.0.0.0", port=8000, loop=loop, http="httptools", workers=1)
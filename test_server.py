@@ -0,0 +1,146 @@
+import asyncio
+import os
+
+os.environ.setdefault("CLIENT_ID", "test-client-id")
+os.environ.setdefault("CLIENT_SECRET", "test-client-secret")
+os.environ.setdefault("REDIRECT_URI", "http://localhost:8000/callback")
+os.environ["API_KEY"] = "test-api-key"
+
+import httpx
+import pytest
+import spotipy
+from fastapi.testclient import TestClient
+
+import server
+
+ORIGIN = "http://localhost:3000"
+
+
+async def ok_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/plain")]})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+@pytest.fixture
+def client():
+    with TestClient(server.app) as client:
+        yield client
+
+
+def mock_spotify(handler):
+    server.app.state.spotify_http = httpx.AsyncClient(transport=httpx.MockTransport(handler),
+                                                      base_url="https://api.spotify.com")
+
+
+# API key middleware
+def test_missing_api_key_is_rejected(client):
+    response = client.get("/")
+    assert response.status_code == 401
+    assert response.json() == {"detail": "Unauthorized. Invalid or missing API key."}
+
+
+def test_wrong_api_key_is_rejected(client):
+    assert client.get("/", headers={"X-API-Key": "wrong"}).status_code == 401
+
+
+def test_valid_api_key_is_accepted(client):
+    response = client.get("/", headers={"X-API-Key": "test-api-key"})
+    assert response.status_code == 200
+
+
+def test_unprotected_path_needs_no_api_key(client):
+    assert client.get("/auth").status_code == 200
+
+
+# CORS middleware
+def test_preflight_from_allowed_origin(client):
+    response = client.options("/play", headers={
+        "Origin": ORIGIN,
+        "Access-Control-Request-Method": "POST",
+        "Access-Control-Request-Headers": "x-api-key",
+    })
+    assert response.status_code == 204
+    assert response.headers["access-control-allow-origin"] == ORIGIN
+    assert response.headers["access-control-allow-credentials"] == "true"
+    assert response.headers["access-control-allow-methods"] == "GET,POST,OPTIONS"
+    assert response.headers["access-control-allow-headers"] == "x-api-key"
+
+
+def test_allowed_origin_gets_cors_headers_on_responses(client):
+    response = client.get("/", headers={"Origin": ORIGIN})
+    assert response.status_code == 401
+    assert response.headers["access-control-allow-origin"] == ORIGIN
+
+
+def test_disallowed_origin_passes_through(client):
+    response = client.options("/auth", headers={"Origin": "http://evil.example",
+                                                "Access-Control-Request-Method": "GET"})
+    assert response.status_code != 204
+    assert "access-control-allow-origin" not in response.headers
+    response = client.get("/auth", headers={"Origin": "http://evil.example"})
+    assert response.status_code == 200
+    assert "access-control-allow-origin" not in response.headers
+
+
+# Rate limiting middleware
+def test_rate_limit_returns_429_once_bucket_is_drained():
+    limiter = server.TokenBucketASGI(ok_app, rate=0.01, capacity=2, limited_paths=["/limited"])
+    client = TestClient(limiter)
+    assert client.get("/limited").status_code == 200
+    assert client.get("/limited").status_code == 200
+    response = client.get("/limited")
+    assert response.status_code == 429
+    assert int(response.headers["retry-after"]) >= 1
+    assert client.get("/other").status_code == 200
+
+
+def test_rate_limit_uses_last_forwarded_for_header_from_trusted_proxy():
+    limiter = server.TokenBucketASGI(ok_app, rate=0.01, capacity=1, limited_paths=["/limited"],
+                                     trusted_proxies=["10.0.0.1"])
+    statuses = []
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            statuses.append(message["status"])
+
+    async def request(spoofed_ip):
+        # The client sends its own X-Forwarded-For, the proxy adds a second header line
+        scope = {"type": "http", "method": "GET", "path": "/limited", "client": ("10.0.0.1", 1234),
+                 "headers": [(b"x-forwarded-for", spoofed_ip.encode()), (b"x-forwarded-for", b"203.0.113.7")]}
+        await limiter(scope, None, send)
+
+    asyncio.run(request("1.1.1.1"))
+    asyncio.run(request("2.2.2.2"))
+    assert statuses == [200, 429]
+    assert list(limiter.buckets) == ["203.0.113.7"]
+
+
+# Spotify requests
+def test_spotify_request_raises_on_404():
+    mock_spotify(lambda request: httpx.Response(404, json={"error": {"status": 404, "message": "Device not found"}}))
+    with pytest.raises(spotipy.exceptions.SpotifyException) as excinfo:
+        asyncio.run(server.spotify_request("PUT", "/v1/me/player/play", "token"))
+    assert excinfo.value.http_status == 404
+
+
+@pytest.mark.parametrize("response", [httpx.Response(204), httpx.Response(200, text="not json")])
+def test_spotify_request_returns_none_for_empty_or_non_json_body(response):
+    mock_spotify(lambda request: response)
+    assert asyncio.run(server.spotify_request("PUT", "/v1/me/player/pause", "token")) is None
+
+
+def test_spotify_request_retries_after_429():
+    responses = iter([httpx.Response(429, headers={"Retry-After": "0"}), httpx.Response(200, json={"devices": []})])
+    mock_spotify(lambda request: next(responses))
+    assert asyncio.run(server.spotify_request("GET", "/v1/me/player/devices", "token")) == {"devices": []}
+
+
+def test_playback_route_maps_spotify_404_to_device_not_found(client):
+    mock_spotify(lambda request: httpx.Response(404, json={"error": {"status": 404, "message": "Not found"}}))
+    server.app.dependency_overrides[server.get_access_token] = lambda: "token"
+    try:
+        response = client.post("/pause", json={"device_id": "missing"}, headers={"X-API-Key": "test-api-key"})
+    finally:
+        server.app.dependency_overrides.clear()
+    assert response.status_code == 404
+    assert response.json() == {"detail": "Device not found."}